@@ -9,6 +9,11 @@ Sushumna Khandelwal, sushumna@usc.edu
 Dependencies: 
 1. numpy : pip install numpy
 2. matplotlib : pip install matplotlib
+3. scipy : pip install scipy
+4. joblib : pip install joblib
+5. numba (optional) : pip install numba
+   k-means assignment and 2-d gmm densities run as parallel compiled kernels when available, the thread count
+   can be limited with the NUMBA_NUM_THREADS environment variable
 
 Output:
 Returns a k-means and gmm model, writes model parameters on console and generates the plot of the same
@@ -19,9 +24,58 @@ import numpy as np
 import random
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+from scipy.linalg import solve_triangular
+from scipy.special import logsumexp
 import math
-import copy
 import itertools
+from joblib import Parallel, delayed
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _assign(X, C, labels):
+        '''
+        Assigns every data point to its closest centroid without materialising the distance matrix
+        :param X: data points
+        :param C: centroids
+        :param labels: output array filled with the closest cluster_id of each data point
+        :return: returns nothing
+        '''
+        for i in prange(X.shape[0]):
+            best = 0
+            best_dist = 1e300
+            for k in range(C.shape[0]):
+                dist = 0.0
+                for j in range(X.shape[1]):
+                    t = X[i, j] - C[k, j]
+                    dist += t * t
+                if dist < best_dist:
+                    best_dist = dist
+                    best = k
+            labels[i] = best
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _logpdf_2d(X, mu, chol, log_norm, out):
+        '''
+        Computes the log density of 2-d data points under one gaussian with an unrolled 2x2 triangular solve
+        :param X: data points of dimension 2
+        :param mu: mean of the gaussian
+        :param chol: lower cholesky factor of the 2x2 co-variance of the gaussian
+        :param log_norm: log of the normalisation constant, d*log(2*pi) + log determinant of the co-variance
+        :param out: output array filled with the log density of each data point
+        :return: returns nothing
+        '''
+        l00, l10, l11 = chol[0, 0], chol[1, 0], chol[1, 1]
+        for i in prange(X.shape[0]):
+            # y = L^-1 (x - mu) by forward substitution, |y|^2 is the squared mahalanobis distance
+            y0 = (X[i, 0] - mu[0]) / l00
+            y1 = (X[i, 1] - mu[1] - l10 * y0) / l11
+            out[i] = -0.5 * (log_norm + y0 * y0 + y1 * y1)
 
 
 class k_means:
@@ -38,68 +92,54 @@ class k_means:
         :param error_rate: error which can be accomodated in model
         :return: return object for running k-means
         '''
-        self.input_data = input_data
+        self.input_data = np.ascontiguousarray(input_data, dtype=np.float64)
         self.n_clusters = n_clusters
         self.error_rate = error_rate
         self.max_limit = max_limit
         self.error_rate = error_rate
-        self.centroid = dict()  # {1:(),2:()..n_clusters}
-        self.clusters = dict()  # {1:[(),(),(),],2:[(),(),(),]..n_clusters}
+        self.centroids = np.empty((n_clusters, self.input_data.shape[1]))  # row i is the centroid of cluster i
+        self.labels = np.empty(self.input_data.shape[0], dtype=np.int32)  # cluster_id of each data point
 
     def gen_random_centroid(self):
         '''
-        Generates initial random centroids from the input data
+        Generates initial random centroids from the input data using k-means++ seeding, each
+        new centroid is drawn with probability proportional to its squared distance to the closest chosen one
         :return: returns nothing
         '''
-        list_centroid = self.input_data[np.random.choice(self.input_data.shape[0], self.n_clusters, replace=False), :]
-        for i in range(self.n_clusters):
-            self.centroid[i] = list_centroid[i]
-            self.clusters[i] = []
+        n_points = self.input_data.shape[0]
+        self.centroids[0] = self.input_data[np.random.randint(n_points)]
+        closest_dist = np.sum((self.input_data - self.centroids[0]) ** 2, axis=1)
+        for k in range(1, self.n_clusters):
+            total = closest_dist.sum()
+            # every point already coincides with a centroid, fall back to a uniform draw
+            weights = closest_dist / total if total > 0 else None
+            self.centroids[k] = self.input_data[np.random.choice(n_points, p=weights)]
+            np.minimum(closest_dist, np.sum((self.input_data - self.centroids[k]) ** 2, axis=1), out=closest_dist)
 
     def e_step(self):
         '''
         Runs e-step of the k-means, to find closest centroid and assign the data to that cluster
         :return: returns nothing
         '''
-        for data in self.input_data:
-            id_ = self.find_closest_centroid(data)
-            self.clusters[id_].append(data)
-
-    def find_closest_centroid(self, point):
-        '''
-        Finds the closest centroid to the input data point
-        :param point: data point
-        :return: returns closest cluster_id
-        '''
-        closest_dist = float("inf")
-        closest_centroid = None
-
-        for each in self.centroid.keys():
-            dist = self.calculate_distance(self.centroid[each], point)
-            if dist < closest_dist:
-                closest_dist = dist
-                centroid_id = each
-
-        return centroid_id
-
-    def calculate_distance(self, centroid, cluster):
-        '''
-        Calculates euclidean distance between 2 points
-        :param centroid: point 1
-        :param cluster: point 2
-        :return: return euclidean distance
-        '''
-        return np.linalg.norm(centroid - cluster)
+        if NUMBA_AVAILABLE:
+            _assign(self.input_data, self.centroids, self.labels)
+            return
+        # squared euclidean distance of every point to every centroid, |x|^2 + |c|^2 - 2x.c
+        dist = np.einsum('ij,ij->i', self.input_data, self.input_data)[:, None] + \
+               np.einsum('ij,ij->i', self.centroids, self.centroids)[None, :] - \
+               2.0 * self.input_data @ self.centroids.T
+        self.labels[:] = dist.argmin(axis=1)
 
     def m_step(self):
         '''
         Runs m-step of k-means algorith to recompute centroids from clusters generated by e-step
         :return: returns nothing
         '''
-        for key in self.clusters.keys():
-            list_of_points = self.clusters[key]
-            new_centroid = np.mean(list_of_points, axis=0)
-            self.centroid[key] = new_centroid
+        sums = np.zeros((self.n_clusters, self.input_data.shape[1]))
+        np.add.at(sums, self.labels, self.input_data)
+        counts = np.bincount(self.labels, minlength=self.n_clusters)
+        non_empty = counts > 0  # an empty cluster keeps its previous centroid
+        self.centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
 
     def execute(self):
         '''
@@ -109,15 +149,15 @@ class k_means:
         self.gen_random_centroid()
         current_error = float("inf")
         current_iteration = 1
+        previous_labels = np.full_like(self.labels, -1)
         while current_error > self.error_rate and current_iteration < self.max_limit:
             self.e_step()
-            old_centroid = copy.copy(self.centroid)  # copy dict
+            if np.array_equal(self.labels, previous_labels):
+                break  # assignments did not change, so neither will the centroids
+            previous_labels[:] = self.labels
+            old_centroids = self.centroids.copy()
             self.m_step()
-            new_centroid = copy.copy(self.centroid)  # copy dict
-            dif_list = []
-            for each in self.centroid:
-                dif_list.append(abs(new_centroid[each] - old_centroid[each]))
-            current_error = np.mean(dif_list)
+            current_error = np.mean(np.abs(self.centroids - old_centroids))
             current_iteration += 1
 
     def get_metric(self):
@@ -125,11 +165,8 @@ class k_means:
         Calculates metric for a model
         :return: returns the metric value
         '''
-        metric = 0
-        for each in self.clusters:
-            for point in self.clusters[each]:
-                metric += self.calculate_distance(self.centroid[each], point)
-        return metric
+        # distance of every point to the centroid of its own cluster
+        return np.sum(np.linalg.norm(self.input_data - self.centroids[self.labels], axis=1))
 
     def get_radii(self, cluster_id):
         '''
@@ -137,10 +174,10 @@ class k_means:
         :param cluster_id: cluster_id
         :return: returns radius of the cluster
         '''
-        radii = float('-inf')
-        for point in self.clusters[cluster_id]:
-            radii = max(radii, self.calculate_distance(self.centroid[cluster_id], point))
-        return radii
+        points = self.input_data[self.labels == cluster_id]
+        if not points.shape[0]:
+            return float('-inf')
+        return np.linalg.norm(points - self.centroids[cluster_id], axis=1).max()
 
     def plot(self):
         '''
@@ -148,13 +185,13 @@ class k_means:
         :return: returns nothing
         '''
         colors = list("rgy")
-        for each in self.clusters:
-            temp = np.asarray(self.clusters[each])
+        for each in range(self.n_clusters):
+            temp = self.input_data[self.labels == each]
             plt.scatter(temp[:, 0], temp[:, 1], color=colors.pop(), )
         print("------------K-Means------------")
         print("Centroid:")
-        print(self.centroid)
-        centers = np.asarray(list(self.centroid.values()))
+        print(self.centroids)
+        centers = self.centroids
         axes = plt.gca()
         plt.scatter(centers[:, 0], centers[:, 1], c='black')
         for i in range(self.n_clusters):
@@ -168,129 +205,111 @@ class gmm:
     gmm class defines functions and variables to run the gmm algorithm
     '''
 
-    def __init__(self, data, max_iteration, n_clusters, threshold=0.5):
+    def __init__(self, data, max_iteration, n_clusters, threshold=0.5, dtype=np.float64):
         '''
         Constructs gmm object
         :param data: input data to make the model
         :param max_iteration: maximum number of iterations for convergence
         :param n_clusters: no. of clusters to be generated
         :param threshold: error which can be accomodated in model
+        :param dtype: floating point type of the data and gaussian parameters, np.float32 halves memory traffic
         :return: return object for running gmm
         '''
-        self.input_data = data
+        self.input_data = np.asarray(data, dtype=dtype)
         self.max_iteration = max_iteration
         self.n_clusters = n_clusters
         self.threshold = threshold
-        self.ric = np.full((self.input_data.shape[0], n_clusters), 1 / self.n_clusters)
+        self.ric = np.full((self.input_data.shape[0], n_clusters), 1 / self.n_clusters, dtype=dtype)
         for i in range(self.ric.shape[0]):
             x = random.uniform(0, 1)
             y = random.uniform(0, (1 - x))
             z = 1 - (x + y)
             self.ric[i] = np.asarray([x, y, z])
         # print(self.ric)
-        self.mu = np.zeros((n_clusters, self.input_data.shape[1]))
+        self.mu = np.zeros((n_clusters, self.input_data.shape[1]), dtype=dtype)
         # print(self.mu)
-        self.cov = np.zeros((n_clusters, self.input_data.shape[1], self.input_data.shape[1]))
+        self.cov = np.zeros((n_clusters, self.input_data.shape[1], self.input_data.shape[1]), dtype=dtype)
         # print(self.cov)
-        self.pi = np.zeros(n_clusters)
-        self.likelihood = 0
+        # cholesky of cov
+        self.chol = np.zeros((n_clusters, self.input_data.shape[1], self.input_data.shape[1]), dtype=dtype)
+        self.log_det = np.zeros(n_clusters, dtype=dtype)  # log determinant of cov
+        self._d = self.input_data.shape[1]
+        self._log2pi = self._d * math.log(2 * math.pi)  # log of the (2*pi)^d normalisation constant
+        self._diff_buf = np.empty(self.input_data.shape, dtype=dtype)  # reused for input_data - mu of each gaussian
+        self.pi = np.zeros(n_clusters, dtype=dtype)
+        self.likelihood = float('-inf')
+        self._cached_logp = None  # log densities of input_data for the current parameters
         # print(self.pi)
 
-    def probability_density(self, i, gaussian_id):
+    def _log_prob_matrix(self, X):
         '''
-        Computes the probablility density function for multivariate normal distribution
-        :param gaussian_id: gaussian_id
-        :returns : return pdf(probability density function) value
-        '''
-        try:
-            probability = 1 / pow((2 * math.pi), -self.n_clusters / 2) * pow(abs(np.linalg.det(self.cov[gaussian_id])),
-                                                                             -1 / 2) * \
-                          np.exp(-1 / 2 * np.dot(np.dot((self.input_data[i] - self.mu[gaussian_id]).T,
-                                                        np.linalg.inv(self.cov[gaussian_id])),
-                                                 (self.input_data[i] - self.mu[gaussian_id])))
-        except:
-            print(np.linalg.inv(self.cov[gaussian_id]))
-        return probability
+        Computes the log of the multivariate normal density of every data point under every gaussian
+        :param X: data points
+        :returns : returns (no. of data points, n_clusters) matrix of log densities
+        '''
+        log_prob = np.empty((X.shape[0], self.n_clusters), dtype=self.input_data.dtype)
+        for k in range(self.n_clusters):
+            if NUMBA_AVAILABLE and self._d == 2:
+                _logpdf_2d(X, self.mu[k], self.chol[k], self._log2pi + self.log_det[k], log_prob[:, k])
+                continue
+            if X is self.input_data:
+                diff = np.subtract(X, self.mu[k], out=self._diff_buf)
+            else:
+                diff = X - self.mu[k]
+            # y = L^-1 (x - mu), so |y|^2 is the squared mahalanobis distance
+            y = solve_triangular(self.chol[k], diff.T, lower=True)
+            maha = np.einsum('ij,ij->j', y, y)
+            log_prob[:, k] = -0.5 * (self._log2pi + self.log_det[k] + maha)
+        return log_prob
 
     def e_step(self):
         '''
         Runs e-step of the gmm, to calculate gaussian parameters mean,co-variance and amplitude
         :return: returns nothing
         '''
+        n_k = np.sum(self.ric, axis=0)  # effective no. of points of each gaussian
+        self.mu[:] = (self.ric.T @ self.input_data) / n_k[:, None]
+        self.pi[:] = n_k / self.input_data.shape[0]
         for i in range(self.n_clusters):
-            self.calculate_mu(i)
-            self.calculate_pi(i)
-            self.calculate_sigma(i)
+            self.calculate_sigma(i, n_k[i])
+        self._cached_logp = None  # parameters changed, cached log densities are stale
 
     def m_step(self):
         '''
         Runs m-step of the gmm, to calculate responsibility/membership for each data point
         :return: returns nothing
         '''
-        for i in range(self.n_clusters):
-            self.calculate_ric(i)
-
-    def calculate_mu(self, gaussian_id):
-        """
-        Computes the mean for a gaussian and updates the mean value
-        :param gaussian_id: gaussian_id
-        :returns : returns nothing
-        """
-        ric = self.ric[:, gaussian_id]
-        avg = np.average(self.input_data, axis=0, weights=ric)
-        self.mu[gaussian_id] = avg
+        if self._cached_logp is None:
+            self._cached_logp = self._log_prob_matrix(self.input_data)
+        # normalise each row in log space, ric = pi * pdf / sum(pi * pdf), reusing the ric buffer
+        np.add(self._cached_logp, np.log(self.pi), out=self.ric)
+        self.ric -= logsumexp(self.ric, axis=1, keepdims=True)
+        np.exp(self.ric, out=self.ric)
 
-    def calculate_sigma(self, gaussian_id):
+    def calculate_sigma(self, gaussian_id, n_k):
         '''
         Computes the co-variance for a gaussian and updates the covariance matrix
         :param gaussian_id: gaussian_id
+        :param n_k: sum of the responsibilities of the gaussian
         :returns : returns nothing
         '''
-        summ = np.zeros((self.input_data.shape[1], self.input_data.shape[1]))
-        summ1 = np.zeros((self.input_data.shape[1], self.input_data.shape[1]))
-        for i in range(self.input_data.shape[0]):
-            data_temp = self.input_data[i].reshape(self.input_data.shape[1], 1)
-            mu_temp = self.mu[gaussian_id].reshape(self.mu.shape[1], 1)
-            diff_temp = data_temp - mu_temp
-            summ += self.ric[i, gaussian_id] * np.dot(diff_temp, diff_temp.T)
-
-        self.cov[gaussian_id] = summ / np.sum(self.ric[:, gaussian_id])
-
-    def calculate_ric(self, gaussian_id):
-        '''
-        Computes the ric for all data points for a gaussian_id and updates the ric value
-        :param gaussian_id: gaussian_id
-        :returns : returns nothing
-        '''
-        for i in range(self.input_data.shape[0]):
-            summ = 0
-            for each in range(self.n_clusters):
-                summ += self.pi[each] * self.probability_density(i, each)
-
-            self.ric[i][gaussian_id] = self.pi[gaussian_id] * self.probability_density(i, gaussian_id) / summ
-            # print(self.ric)
-
-    def calculate_pi(self, gaussian_id):
-        '''
-        Computes the amplitude for a gaussian and updates the amplitude
-        :param gaussian_id: gaussian_id
-        :returns : returns nothing
-        '''
-        self.pi[gaussian_id] = np.sum(self.ric[:, gaussian_id]) / self.input_data.shape[0]
+        diff = np.subtract(self.input_data, self.mu[gaussian_id], out=self._diff_buf)
+        ric = self.ric[:, gaussian_id]
+        # weighted sum of outer products as a single matrix product
+        self.cov[gaussian_id] = (diff.T * ric) @ diff / n_k
+        # factorise once here so density evaluations never invert the covariance
+        self.chol[gaussian_id] = np.linalg.cholesky(self.cov[gaussian_id])
+        self.log_det[gaussian_id] = 2 * np.sum(np.log(np.diag(self.chol[gaussian_id])))
 
     def get_likelihood(self):
         '''
         Calculates the log likelihood
         :return : returns log likelihood
         '''
-        new_likelihood = 0
-        for i in range(self.input_data.shape[0]):
-            temp = 0
-            for k in range(self.n_clusters):
-                temp += self.pi[k] * self.probability_density(i, k)
-            new_likelihood += np.log(temp)
-
-        return new_likelihood
+        if self._cached_logp is None:
+            self._cached_logp = self._log_prob_matrix(self.input_data)
+        # accumulate in float64 even for float32 models, the sum runs over every data point
+        return np.sum(logsumexp(self._cached_logp + np.log(self.pi), axis=1), dtype=np.float64)
 
     def execute(self):
         '''
@@ -313,17 +332,7 @@ class gmm:
         :param X: data points
         :return: predicted cluster based on highest responsibility gamma.
         '''
-        labels = np.zeros(X.shape[0])
-
-        for i in range(X.shape[0]):
-            max_density = 0
-            for c in range(self.n_clusters):
-                density = self.pi[c] * self.probability_density(i, c)
-                if max_density < density:
-                    labels[i] = c
-                    max_density = density
-
-        return labels
+        return np.argmax(self._log_prob_matrix(X) + np.log(self.pi), axis=1)
 
     def plot(self):
         '''
@@ -338,18 +347,13 @@ class gmm:
         print("Covariance")
         print(self.cov)
 
-        centers = np.zeros((self.n_clusters, 2))
-        predicted_values = self.predict(self.input_data)
+        if self._cached_logp is None:
+            self._cached_logp = self._log_prob_matrix(self.input_data)
+        # same labels as predict(self.input_data), without a second density pass
+        predicted_values = np.argmax(self._cached_logp + np.log(self.pi), axis=1)
         axes = plt.gca()
-        for c in range(self.n_clusters):
-            max_density = 0
-            point = None
-            for i in range(self.input_data.shape[0]):
-                density = math.log(self.probability_density(i, c))
-                if max_density < density:
-                    max_density = density
-                    point = self.input_data[i]
-            centers[c, :] = point
+        # data point with the highest density under each gaussian
+        centers = self.input_data[np.argmax(self._cached_logp, axis=0)]
         print("Centers")
         print(centers)
         color_iter = itertools.cycle(['navy', 'cornflowerblue', 'gold', 'darkorange'])
@@ -384,17 +388,31 @@ def main():
     gmm_obj.plot()
 
 
-def run_k_means(data, no_of_runs):
+def _fit_one(data, n_clusters, max_limit, error_rate):
+    '''
+    Runs a single k-means model, used as one independent restart of run_k_means
+    :param data: input data to make the model
+    :param n_clusters: no. of clusters to be generated
+    :param max_limit: maximum number of iterations for convergence
+    :param error_rate: error which can be accomodated in model
+    :return: returns the fitted k-means model and its metric
+    '''
+    k_obj = k_means(data, n_clusters, max_limit, error_rate)
+    k_obj.execute()
+    return k_obj, k_obj.get_metric()
+
+
+def run_k_means(data, no_of_runs, n_jobs=-1):
     '''
-    Runs the k-means multiple times and gets the best model
+    Runs the k-means multiple times in parallel and gets the best model
     :param no of runs: #runs
+    :param n_jobs: no. of parallel workers, -1 uses all cores
     :return: returns best k-means model
     '''
-    metrics = dict()
-    for i in range(no_of_runs):
-        k_obj = k_means(data, 3, 100, 0.01)
-        k_obj.execute()
-        metrics[k_obj] = k_obj.get_metric()
+    # joblib caps NUMBA_NUM_THREADS and the BLAS threads of each worker to cores // n_jobs,
+    # so the parallel numba assignment does not oversubscribe the cores used by the restarts
+    runs = Parallel(n_jobs=n_jobs)(delayed(_fit_one)(data, 3, 100, 0.01) for _ in range(no_of_runs))
+    metrics = dict(runs)
     key = min(metrics, key=metrics.get)
     print(metrics)
     return key